@@ -1,7 +1,36 @@
 import maya.cmds as cmds
 import maya.mel as mel
+import concurrent.futures
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
 from enum import Enum
-import os, platform, stat, sys, subprocess, tempfile
+import logging, os, re, stat, sys, time
+
+try:
+    from P4 import P4, P4Exception
+except ImportError:
+    P4 = P4Exception = None  # Perforce for Maya is optional, checked via has_perforce_installed
+
+
+log = logging.getLogger('BatchScriptExecution')
+
+_SLASH_TABLE = str.maketrans('\\', '/')  # We don't want a back-slash on windows
+MAYA_EXTS = ('.mb', '.ma')
+
+_CHECKOUT_HINT_NOT_ON_CLIENT = "The file does not exist in perforce, use 'Make Writable'."
+_CHECKOUT_ERROR_FMT = "Failed to check out: {path}. Error: {error}\n\nHint: {hint}"
+_CHECKOUT_DIALOG_MAX_ERRORS = 10  # Beyond this the dialog would be taller than the screen
+_CHECKOUT_DIALOG_FMT = "{errors}\n\nAsk Jared or Cort for instructions (copy/paste this error from the Maya Script Editor)"
+
+
+@lru_cache(maxsize=4)
+def _read_p4config(config_path, mtime):
+    """Parses a p4config file, mtime is only part of the cache key so that edits to the file are picked up"""
+    with open(config_path, 'r') as file:
+        lines = [line.strip() for line in file]
+    return {key.strip(): value.strip() for key, _, value in (line.partition('=') for line in lines if '=' in line)}
 
 
 class BatchScriptExecutionStatics:
@@ -17,6 +46,8 @@ class BatchScriptExecutionHelper:
             cmds.warning("Directory does not exist:", path)
             return
 
+        import subprocess
+
         if sys.platform == 'win32':
             # Windows
             os.startfile(path)
@@ -40,6 +71,8 @@ class BatchScriptExecutionHelper:
         else:
             path = os.path.dirname(file_path)
 
+        import subprocess
+
         if sys.platform == 'win32':
             # Windows: Use explorer /select to open the folder and select the file
             if os.path.isdir(file_path):
@@ -79,26 +112,48 @@ class FileResult(Enum):
     file_read_only = 6
     file_skipped = 7
 
+@dataclass(frozen=True)
+class BatchConfig:
+    """Snapshot of the UI settings for one batch, read once so the per-file work never queries the UI"""
+    command: str
+    command_type: str  # "python" or "mel"
+    wants_save: bool
+    recursion_depth: int
+    file_types: frozenset  # Lowercase extensions without the dot, empty allows every Maya file
+    skip_re: object = None  # Compiled prefix/suffix/filter pattern, None when no filters are set
+    code: object = None  # Python command compiled once per batch, MEL has no equivalent and is evaluated per file
+
 class PendingFile:
-    path = None
-    file_name = None
-    status = None
-    result = None
-    warning = None
+    # Slots rather than class attribute defaults, there can be tens of thousands of these
+    __slots__ = ('path', 'file_name', 'status', 'result', 'warning',
+                 'skip_file', 'handler', 'access_handler_entry')
+
+    def __init__(self, path, file_name = None, stat_result = None):
+        self.result = None
+        self.warning = None
 
-    skip_file = False  # set by BatchScriptExecutionAccessEntry
+        self.skip_file = False  # set by BatchScriptExecutionAccessEntry
+        self.handler = None  # set by BatchScriptExecutionAccessHandler, notified of status changes
+        self.access_handler_entry = None  # set by BatchScriptExecutionAccessHandler
 
-    def __init__(self, path, file_name = None):
         self.path = path
-        self.file_name = file_name
-        self.status = BatchScriptExecutionAccessEntry.check_file_status(self.path)
+        self.file_name = file_name or os.path.basename(path)
+        if stat_result is not None:
+            # Already stat'd while gathering, no need to hit the disk again
+            self.status = BatchScriptExecutionAccessEntry._status_from_mode(stat_result.st_mode)
+        else:
+            self.status = BatchScriptExecutionAccessEntry.check_file_status(self.path)
+
+    def set_status(self, status):
+        old_status = self.status
+        self.status = status
+        if self.handler and old_status != status:
+            self.handler._on_status_change(old_status, status)
 
 class BatchScriptExecutionEqualButton:
     def __init__(self, label, parent, command=None, height=0):
-        if height == 0:
-            self.button = cmds.button(label=label, p=parent, command=command)
-        else:
-            self.button = cmds.button(label=label, h=height, p=parent, command=command)
+        size = {"h": height} if height else {}
+        self.button = cmds.button(label=label, p=parent, command=command, **size)
 
 class BatchScriptExecutionFiveEqualButtons:
     def __init__(self, parent, button1_label, button2_label, button3_label, button4_label, button5_label,
@@ -107,29 +162,21 @@ class BatchScriptExecutionFiveEqualButtons:
         self.layout = cmds.formLayout()
 
         # Create five buttons
-        self.button1 = BatchScriptExecutionEqualButton(button1_label, self.layout, button1_command, height)
-        self.button2 = BatchScriptExecutionEqualButton(button2_label, self.layout, button2_command, height)
-        self.button3 = BatchScriptExecutionEqualButton(button3_label, self.layout, button3_command, height)
-        self.button4 = BatchScriptExecutionEqualButton(button4_label, self.layout, button4_command, height)
-        self.button5 = BatchScriptExecutionEqualButton(button5_label, self.layout, button5_command, height)
-
-        # Define the form layout with appropriate attach forms and positions
-        cmds.formLayout(self.layout, edit=True,
-                        attachForm=[(self.button1.button, 'top', spacing),
-                                    (self.button1.button, 'left', spacing),
-                                    (self.button2.button, 'top', spacing),
-                                    (self.button3.button, 'top', spacing),
-                                    (self.button4.button, 'top', spacing),
-                                    (self.button5.button, 'top', spacing),
-                                    (self.button5.button, 'right', spacing)],  # Attach the right edge of button5
-                        attachPosition=[(self.button1.button, 'right', spacing, 20),
-                                        (self.button2.button, 'left', spacing, 20),
-                                        (self.button2.button, 'right', spacing, 40),
-                                        (self.button3.button, 'left', spacing, 40),
-                                        (self.button3.button, 'right', spacing, 60),
-                                        (self.button4.button, 'left', spacing, 60),
-                                        (self.button4.button, 'right', spacing, 80),
-                                        (self.button5.button, 'left', spacing, 80)])
+        labels = (button1_label, button2_label, button3_label, button4_label, button5_label)
+        commands = (button1_command, button2_command, button3_command, button4_command, button5_command)
+        self.buttons = [BatchScriptExecutionEqualButton(label, self.layout, command, height) for label, command in zip(labels, commands)]
+        self.button1, self.button2, self.button3, self.button4, self.button5 = self.buttons
+
+        # Each button spans 20% of the width, the outer edges attach to the form itself
+        width = 100 // len(self.buttons)
+        attach_form = [(b.button, 'top', spacing) for b in self.buttons]
+        attach_form += [(self.buttons[0].button, 'left', spacing), (self.buttons[-1].button, 'right', spacing)]
+        attach_position = [(b.button, side, spacing, position)
+                           for i, b in enumerate(self.buttons)
+                           for side, position in (('left', width * i), ('right', width * (i + 1)))
+                           if 0 < position < 100]
+
+        cmds.formLayout(self.layout, edit=True, attachForm=attach_form, attachPosition=attach_position)
 
 class BatchScriptExecutionAccessEntry:
     """A single entry in the BatchScriptExecutionAccessHandler"""
@@ -143,11 +190,36 @@ class BatchScriptExecutionAccessEntry:
     invalid_color = [0.5, 0.25, 0.25]
     alt_invalid_color = [0.1, 0.1, 0.1]
 
-    def __init__(self, handler, layout, file):
+    _READY_TEXT = {
+        FileStatus.read_only: "Failed",
+        FileStatus.writable: "Ready",
+        FileStatus.does_not_exist: "Ready",
+    }
+    _READY_COLOR = {
+        FileStatus.skip: alt_invalid_color,
+        FileStatus.read_only: invalid_color,
+        FileStatus.writable: valid_color,
+        FileStatus.does_not_exist: valid_color,
+    }
+    _STATUS_TEXT = {
+        FileStatus.skip: "Skip",
+        FileStatus.read_only: "Read-Only",
+        FileStatus.writable: "Replace",
+        FileStatus.does_not_exist: "New File",
+    }
+    _STATUS_COLOR = {
+        FileStatus.skip: alt_invalid_color,
+        FileStatus.read_only: invalid_color,
+        FileStatus.writable: alt_valid_color,
+        FileStatus.does_not_exist: valid_color,
+    }
+
+    _stat_cache = {}  # normalized path -> (FileStatus, timestamp)
+    _STAT_TTL = 1.0  # seconds before a cached status is considered stale
+
+    def __init__(self, handler, layout, file, defer_refresh=False):
         self.handler = handler
         self.file = file
-        if self.file.file_name is None:
-            self.file.file_name = file.path.split("/")[-1]
 
         column_layout = cmds.columnLayout(adj=1, columnAlign="left", parent=layout)
         cmds.separator(h=4, style="none", p=column_layout)
@@ -164,30 +236,26 @@ class BatchScriptExecutionAccessEntry:
 
         cmds.separator(w=10, style="none", p=row_layout)
 
-        self.checkout_button = cmds.button(l="Checkout", w=90, h=30, c=lambda unused: self.checkout_file(self), p=row_layout)
-        self.writable_button = cmds.button(l="Make Writable", w=90, h=30, c=lambda unused: self.make_writable(self), p=row_layout)
+        self.checkout_button = cmds.button(l="Checkout", w=90, h=30, c=self._on_checkout, p=row_layout)
+        self.writable_button = cmds.button(l="Make Writable", w=90, h=30, c=self._on_make_writable, p=row_layout)
         self.skip_button = cmds.button(l="Skip", w=90, h=30, c=self.skip_file, p=row_layout)
-        self.refresh_button = cmds.button(l="Refresh", w=90, h=30, c=lambda unused: self.refresh(self), p=row_layout)
+        self.refresh_button = cmds.button(l="Refresh", w=90, h=30, c=self._on_refresh, p=row_layout)
 
         cmds.separator(h=1, p=column_layout)
 
-        self.refresh_ui()
+        if not defer_refresh:
+            self.refresh_ui()
 
     @staticmethod
     def has_perforce_installed():
-        try:
-            from P4 import P4, P4Exception
-            return True
-        except ImportError:
-            return False
+        return P4 is not None
 
     def refresh_ui(self):
         status = self.file.status
         dont_skip = status is not FileStatus.skip
         cmds.text(self.file_text, e=1, en=dont_skip)
-        cmds.text(self.ready_text, e=1, bgc=self.get_ready_color(status))
-        cmds.text(self.status_text, e=1, l=self.get_status_text(status),
-                                     bgc=self.get_status_color(status))
+        cmds.text(self.ready_text, e=1, bgc=self._READY_COLOR[status])
+        cmds.text(self.status_text, e=1, l=self._STATUS_TEXT[status], bgc=self._STATUS_COLOR[status])
 
         cmds.button(self.skip_button, e=1, l="Skip" if dont_skip else "Don't Skip")
 
@@ -201,27 +269,49 @@ class BatchScriptExecutionAccessEntry:
 
     @staticmethod
     def check_file_status(path):
-        # Check if the file exists
-        if os.path.exists(path):
-            # Check if the file is writable (not read-only)
-            if os.access(path, os.W_OK):
-                return FileStatus.writable
-            else:
-                return FileStatus.read_only
+        key = os.path.normpath(path)
+        cache = BatchScriptExecutionAccessEntry._stat_cache
+        cached = cache.get(key)
+        now = time.monotonic()
+        if cached and now - cached[1] < BatchScriptExecutionAccessEntry._STAT_TTL:
+            return cached[0]
+
+        # A single stat tells us both whether the file exists and whether it is writable (not read-only)
+        try:
+            st = os.stat(path)
+        except OSError:
+            status = FileStatus.does_not_exist  # Same as os.path.exists, which treats any stat failure as missing
         else:
-            return FileStatus.does_not_exist
+            status = BatchScriptExecutionAccessEntry._status_from_mode(st.st_mode)
+
+        cache[key] = (status, now)
+        return status
+
+    @staticmethod
+    def _status_from_mode(mode):
+        return FileStatus.writable if mode & stat.S_IWRITE else FileStatus.read_only
+
+    @staticmethod
+    def _invalidate(path):
+        BatchScriptExecutionAccessEntry._stat_cache.pop(os.path.normpath(path), None)
+
+    @staticmethod
+    def clear_stat_cache():
+        BatchScriptExecutionAccessEntry._stat_cache.clear()
 
     @staticmethod
     def check_directory_status(directory):
-        # Check if the directory exists
-        if not os.path.exists(directory):
+        # Check if the directory exists, and that it is a directory, from a single stat
+        try:
+            st = os.stat(directory)
+        except OSError:
             return False, "Directory does not exist."
 
-        # Check if the path is a directory
-        if not os.path.isdir(directory):
+        if not stat.S_ISDIR(st.st_mode):
             return False, "Path exists but is not a directory."
 
         # Check if the directory can be written to
+        import tempfile
         try:
             # Attempt to create a temporary file within the directory
             testfile = tempfile.TemporaryFile(dir=directory)
@@ -232,64 +322,129 @@ class BatchScriptExecutionAccessEntry:
         # If all checks pass
         return True, "Directory exists, is valid, and writable."
 
-    def read_p4config(self, config_path):
-        settings = {}
-        with open(config_path, 'r') as file:
-            for line in file:
-                if "=" in line:
-                    key, value = line.strip().split('=', 1)
-                    settings[key.strip()] = value.strip()
-        return settings
-
-    def checkout_file_perforce(self, path):
-        if not self.has_perforce_installed():
-            return False
-
-        from P4 import P4, P4Exception
+    @staticmethod
+    def read_p4config(config_path):
+        return _read_p4config(config_path, os.path.getmtime(config_path))
 
+    @staticmethod
+    def get_perforce_settings():
         has_p4config = cmds.optionVar(exists=BatchScriptExecutionStatics.command_option_perforce_var)
         p4config = cmds.optionVar(query=BatchScriptExecutionStatics.command_option_perforce_var) if has_p4config else ""
         if not p4config:
             cmds.confirmDialog(title="Checkout Failed", message=f"Perforce for Maya could not find a p4config file at {p4config}", button=["Dismiss"], defaultButton="Dismiss",
                                cancelButton="Dismiss", dismissString="Dismiss")
-            return False
+            return None
 
-        config = self.read_p4config(p4config)
+        return BatchScriptExecutionAccessEntry.read_p4config(p4config)
 
+    @staticmethod
+    def run_perforce_edit(config, paths):
+        """Checks out every file in a single connection and round trip, returns a dict of path -> error string
+        for the files that could not be checked out. Does not touch the UI"""
         p4 = P4()
         p4.port = config["P4PORT"]
         p4.client = config["P4CLIENT"]
         p4.user = config["P4USER"]
+        p4.exception_level = 0  # Never raise for per-file problems, they are attributed from p4.errors/p4.warnings below
 
-        print(f"Attempting to connect to Perforce on port {p4.port}, client {p4.client}, user {p4.user}")
-
-        success = False
+        log.debug("Attempting to connect to Perforce on port %s, client %s, user %s", p4.port, p4.client, p4.user)
 
         try:
             p4.connect()
-            print(f"Successfully connected to Perforce")
-            p4.run("edit", path)
-            print(f"Successfully checked out: {path}")
-            success = True
         except P4Exception as e:
-            error_str = f"Failed to check out: {path}. Error: {str(e)}"
-            print(error_str)
-            hint_str = "None"
-            if "not on client." in str(e):
-                hint_str = "The file does not exist in perforce, use 'Make Writable'."
-            cmds.confirmDialog(title="Checkout Failed", message=error_str + "\n\nHint: " + hint_str + "\n\nAsk Jared or Cort for instructions (copy/paste this error from the Maya Script Editor)", button=["Dismiss"], defaultButton="Dismiss",
-                               cancelButton="Dismiss", dismissString="Dismiss")
+            # Nothing was attempted, so every file failed for the same reason
+            return {path: str(e) for path in paths}
+
+        log.debug("Successfully connected to Perforce")
+        results = []
+        try:
+            results = p4.run("edit", *paths)
+        except P4Exception:
+            pass  # The cause is in p4.errors, which is read below
         finally:
-            p4.disconnect()
+            messages = [str(message) for message in list(p4.errors) + list(p4.warnings)]
+            if p4.connected():
+                p4.disconnect()
+
+        checked_out = {os.path.normcase(os.path.normpath(result["clientFile"]))
+                       for result in results if isinstance(result, dict) and "clientFile" in result}
+
+        # Any file perforce didn't confirm as opened has failed. Use the message about that file if there is one,
+        # otherwise the messages that aren't about any one file (e.g. an expired session or unknown client)
+        errors = {}
+        file_messages = set()
+        for path in paths:
+            if os.path.normcase(os.path.normpath(path)) in checked_out:
+                log.debug("Successfully checked out: %s", path)
+                continue
+
+            error = BatchScriptExecutionAccessEntry._find_perforce_message(path, messages)
+            if error is not None:
+                file_messages.add(error)
+            errors[path] = error
+
+        general_error = "; ".join(message for message in messages if message not in file_messages) or "File was not opened for edit."
+        return {path: general_error if error is None else error for path, error in errors.items()}
+
+    @staticmethod
+    def _find_perforce_message(path, messages):
+        """Finds the message about path. Perforce reports per-file problems in either client or depot syntax, so match
+        the full client path first, then the file name bounded by a separator so 'a.ma' doesn't match 'ba.ma'"""
+        client_path = os.path.normcase(os.path.normpath(path)).translate(_SLASH_TABLE)
+        for message in messages:
+            if client_path in os.path.normcase(message).translate(_SLASH_TABLE):
+                return message
+
+        file_name = re.compile(r'(?:^|[/\\])' + re.escape(os.path.basename(path)) + r'(?=[\s#@]|$)')
+        return next((message for message in messages if file_name.search(message)), None)
+
+    @staticmethod
+    def show_checkout_errors(errors):
+        """Reports every failed checkout in a single dialog"""
+        messages = []
+        for path, error in errors.items():
+            message = _CHECKOUT_ERROR_FMT.format(path=path, error=error, hint=_CHECKOUT_HINT_NOT_ON_CLIENT if "not on client." in error else "None")
+            print(message)  # Every failure is printed, the dialog only lists the first few
+            messages.append(message)
+
+        if len(messages) > _CHECKOUT_DIALOG_MAX_ERRORS:
+            hidden = len(messages) - _CHECKOUT_DIALOG_MAX_ERRORS
+            messages = messages[:_CHECKOUT_DIALOG_MAX_ERRORS] + [f"...and {hidden} more, see the Maya Script Editor"]
+        cmds.confirmDialog(title="Checkout Failed", message=_CHECKOUT_DIALOG_FMT.format(errors="\n\n".join(messages)), button=["Dismiss"], defaultButton="Dismiss",
+                           cancelButton="Dismiss", dismissString="Dismiss")
+
+    @staticmethod
+    def show_perforce_missing():
+        cmds.confirmDialog(title="Checkout Failed", message="Perforce for Maya not installed.\n\nAsk Jared or Cort for instructions", button=["Dismiss"], defaultButton="Dismiss",
+                           cancelButton="Dismiss", dismissString="Dismiss")
+
+    @staticmethod
+    def checkout_files_perforce(paths):
+        """Checks out all paths with a single perforce connection, returns True if every file was checked out"""
+        entry = BatchScriptExecutionAccessEntry
+        if not entry.has_perforce_installed():
+            return False
+
+        config = entry.get_perforce_settings()
+        if config is None:
+            return False
 
-        return success
+        errors = entry.run_perforce_edit(config, paths)
+        if errors:
+            entry.show_checkout_errors(errors)
 
+        for path in paths:
+            entry._invalidate(path)
+
+        return not errors
+
+    def checkout_file_perforce(self, path):
+        return self.checkout_files_perforce([path])
 
     @staticmethod
     def checkout_file(self):
         if not self.has_perforce_installed():
-            cmds.confirmDialog(title="Checkout Failed", message="Perforce for Maya not installed.\n\nAsk Jared or Cort for instructions", button=["Dismiss"], defaultButton="Dismiss",
-                               cancelButton="Dismiss", dismissString="Dismiss")
+            self.show_perforce_missing()
             return
         if self.check_file_status(self.file.path) == FileStatus.read_only:
             self.checkout_file_perforce(self.file.path)
@@ -298,6 +453,7 @@ class BatchScriptExecutionAccessEntry:
 
     @staticmethod
     def is_unix():
+        import platform
         os_name = platform.system()
         if os_name == "Windows":
             return False
@@ -321,70 +477,56 @@ class BatchScriptExecutionAccessEntry:
                 os.chmod(path, file_stat.st_mode | stat.S_IWRITE)
             except OSError as e:
                 cmds.error("Error removing read-only attribute:", e)
+        BatchScriptExecutionAccessEntry._invalidate(path)
 
     @staticmethod
     def make_writable(self):
         if self.check_file_status(self.file.path) == FileStatus.read_only:
-            print("make writ")
-            print(self.file.path)
+            log.debug("Make writable: %s", self.file.path)
             self.make_file_writable(self.file.path)
-            print("make writ done")
             self.refresh(self)
             self.handler.update_continue_button(self.handler)
 
     @staticmethod
     def refresh(self):
-        self.file.status = FileStatus.skip if self.file.status is FileStatus.skip else self.check_file_status(self.file.path)
+        self.file.set_status(FileStatus.skip if self.file.status is FileStatus.skip else self.check_file_status(self.file.path))
         # print("refresh ", self.file, "   ", self.file.status)
         self.refresh_ui()
 
+    # Button callbacks, bound methods instead of per-row lambdas. Maya passes the button state, which is ignored
+    def _on_checkout(self, *_):
+        self.checkout_file(self)
+
+    def _on_make_writable(self, *_):
+        self.make_writable(self)
+
+    def _on_refresh(self, *_):
+        # Explicit user refresh, always hit the disk
+        self._invalidate(self.file.path)
+        self.refresh(self)
+
     def skip_file(*args):
         self = args[0]
-        self.file.status = FileStatus.skip if self.file.status is not FileStatus.skip else self.check_file_status(self.file.path)
+        self._invalidate(self.file.path)
+        self.file.set_status(FileStatus.skip if self.file.status is not FileStatus.skip else self.check_file_status(self.file.path))
         self.refresh(self)
         self.handler.update_continue_button(self.handler)
 
-    @staticmethod
-    def get_ready_text(status):
-        if status == FileStatus.read_only:
-            return "Failed"
-        elif status == FileStatus.writable:
-            return "Ready"
-        elif status == FileStatus.does_not_exist:
-            return "Ready"
+    @classmethod
+    def get_ready_text(cls, status):
+        return cls._READY_TEXT.get(status)
 
-    @staticmethod
-    def get_ready_color(status):
-        if status == FileStatus.skip:
-            return BatchScriptExecutionAccessEntry.alt_invalid_color
-        elif status == FileStatus.read_only:
-            return BatchScriptExecutionAccessEntry.invalid_color
-        elif status == FileStatus.writable:
-            return BatchScriptExecutionAccessEntry.valid_color
-        elif status == FileStatus.does_not_exist:
-            return BatchScriptExecutionAccessEntry.valid_color
+    @classmethod
+    def get_ready_color(cls, status):
+        return cls._READY_COLOR.get(status)
 
-    @staticmethod
-    def get_status_text(status):
-        if status == FileStatus.skip:
-            return "Skip"
-        elif status == FileStatus.read_only:
-            return "Read-Only"
-        elif status == FileStatus.writable:
-            return "Replace"
-        elif status == FileStatus.does_not_exist:
-            return "New File"
+    @classmethod
+    def get_status_text(cls, status):
+        return cls._STATUS_TEXT.get(status)
 
-    @staticmethod
-    def get_status_color(status):
-        if status == FileStatus.skip:
-            return BatchScriptExecutionAccessEntry.alt_invalid_color
-        elif status == FileStatus.read_only:
-            return BatchScriptExecutionAccessEntry.invalid_color
-        elif status == FileStatus.writable:
-            return BatchScriptExecutionAccessEntry.alt_valid_color
-        elif status == FileStatus.does_not_exist:
-            return BatchScriptExecutionAccessEntry.valid_color
+    @classmethod
+    def get_status_color(cls, status):
+        return cls._STATUS_COLOR.get(status)
 
 class BatchScriptExecutionAccessHandler:
     """Lists files and allows checking out or making writable or skipping"""
@@ -394,6 +536,10 @@ class BatchScriptExecutionAccessHandler:
     continue_button = None
     checkout_button = None
 
+    status_counts = {}  # FileStatus -> number of files currently in that state
+
+    _suspend_updates = False  # Set during bulk operations so the buttons are only updated once at the end
+
     def __init__(self, title, files):
         self.files = files
 
@@ -404,23 +550,66 @@ class BatchScriptExecutionAccessHandler:
         # Draw each file to screen
         cmds.layoutDialog(title=title, ui=self.spawn_ui)
 
+    def _prime_stat_cache(self):
+        """Stat every file with one directory scan per parent directory, instead of one stat per file"""
+        directories = {}
+        for file in self.files.values():
+            path = os.path.normpath(file.path)
+            directories.setdefault(os.path.dirname(path), set()).add(path)
+
+        cache = BatchScriptExecutionAccessEntry._stat_cache
+        now = time.monotonic()
+        for directory, paths in directories.items():
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        path = os.path.normpath(entry.path)
+                        if path in paths:
+                            cache[path] = (BatchScriptExecutionAccessEntry._status_from_mode(entry.stat().st_mode), now)
+                            paths.discard(path)
+            except OSError:
+                continue
+
+            # Anything the scan didn't find no longer exists
+            for path in paths:
+                cache[path] = (FileStatus.does_not_exist, now)
+
+        for file in self.files.values():
+            if file.status is not FileStatus.skip:
+                file.status = BatchScriptExecutionAccessEntry.check_file_status(file.path)
+
     def spawn_ui(self):
         layout = cmds.setParent(q=True)
-        scroll_layout = cmds.scrollLayout(verticalScrollBarAlwaysVisible=True, width=1000, height=400,
-                                          verticalScrollBarThickness=16, childResizable=True, parent=layout)
+        self._prime_stat_cache()
+
+        # Count statuses once, from here on they are tracked incrementally as files change state
+        self.status_counts = {status: 0 for status in FileStatus}
+        for file in self.files.values():
+            file.handler = self
+            self.status_counts[file.status] += 1
+
+        cmds.waitCursor(state=True)
+        try:
+            scroll_layout = cmds.scrollLayout(verticalScrollBarAlwaysVisible=True, width=1000, height=400,
+                                              verticalScrollBarThickness=16, childResizable=True, parent=layout)
+
+            # Create entries for each file, they are refreshed in a single pass once everything exists
+            for scene, file in self.files.items():
+                file.access_handler_entry = BatchScriptExecutionAccessEntry(self, scroll_layout, file, defer_refresh=True)
 
-        # Create entries for each file
-        for scene, file in self.files.items():
-            file.access_handler_entry = BatchScriptExecutionAccessEntry(self, scroll_layout, file)
+            # Add continue & abort buttons
+            buttons = BatchScriptExecutionFiveEqualButtons(
+                layout, "Checkout All", "Refresh All", "Open Directory", "Continue", "Abort",
+                self.press_checkout_button, self.press_refresh_button, self.press_open_directory_button, self.press_continue_button, self.press_abort_button, 4, 30)
 
-        # Add continue & abort buttons
-        buttons = BatchScriptExecutionFiveEqualButtons(
-            layout, "Checkout All", "Refresh All", "Open Directory", "Continue", "Abort",
-            self.press_checkout_button, self.press_refresh_button, self.press_open_directory_button, self.press_continue_button, self.press_abort_button, 4, 30)
+            self.continue_button = buttons.button4.button
+            self.checkout_button = buttons.button1.button
 
-        self.continue_button = buttons.button4.button
-        self.checkout_button = buttons.button1.button
-        cmds.button(self.continue_button, e=1, en=self.can_continue())
+            with self.suspended_updates():
+                for file in self.files.values():
+                    file.access_handler_entry.refresh_ui()
+        finally:
+            cmds.waitCursor(state=False)
 
         # Attach the scrollLayout edges to the formLayout with some spacing
         cmds.formLayout(
@@ -433,30 +622,56 @@ class BatchScriptExecutionAccessHandler:
 
     @staticmethod
     def update_continue_button(self):
+        if self._suspend_updates:
+            return
+        can_continue = self.can_continue()
         if self.continue_button:
-            cmds.button(self.continue_button, e=1, en=self.can_continue())
+            cmds.button(self.continue_button, e=1, en=can_continue)
         if self.checkout_button:
-            cmds.button(self.checkout_button, e=1, en=not self.can_continue())
+            cmds.button(self.checkout_button, e=1, en=not can_continue)
+
+    @contextmanager
+    def suspended_updates(self):
+        """Defers updating the buttons until the end of a bulk operation"""
+        self._suspend_updates = True
+        try:
+            yield
+        finally:
+            self._suspend_updates = False
+            self.update_continue_button(self)
+
+    def _on_status_change(self, old_status, new_status):
+        self.status_counts[old_status] -= 1
+        self.status_counts[new_status] += 1
+
+    @property
+    def read_only_count(self):
+        return self.status_counts.get(FileStatus.read_only, 0)
 
     def can_continue(self):
-        for scene, file in self.files.items():
-            if file.status == FileStatus.read_only:
-                return False
-        return True
+        return self.read_only_count == 0
 
     def press_checkout_button(*args):
         self = args[0]
-        for scene, files in self.files.items():
-            for file in files:
-                file.access_handler_entry.checkout_file(file.access_handler_entry)
+        entries = [file.access_handler_entry for file in self.files.values() if file.status == FileStatus.read_only]
+        if not entries:
+            return
+
+        if not BatchScriptExecutionAccessEntry.has_perforce_installed():
+            BatchScriptExecutionAccessEntry.show_perforce_missing()
+            return
+
+        # One connection and one 'p4 edit' for every file, rather than a round trip per file
+        BatchScriptExecutionAccessEntry.checkout_files_perforce([entry.file.path for entry in entries])
         self.press_refresh_button(args)
 
     def press_refresh_button(*args):
         self = args[0]
-        for scene, files in self.files.items():
-            for file in files:
+        # Drop every cached status once, so each refresh below stats its file exactly once
+        BatchScriptExecutionAccessEntry.clear_stat_cache()
+        with self.suspended_updates():
+            for file in self.files.values():
                 file.access_handler_entry.refresh(file.access_handler_entry)
-        self.update_continue_button(self)
 
     @staticmethod
     def press_open_directory_button():
@@ -478,6 +693,7 @@ class BatchScriptExecutionAccessHandler:
 
 class BatchScriptExecutionUI:
     last_command = ""
+    _update_generation = 0  # Bumped per text change, so stale deferred button updates can be skipped
 
     def __init__(self):
         if cmds.window(BatchScriptExecutionStatics.window_name, exists=True):
@@ -619,7 +835,10 @@ class BatchScriptExecutionUI:
                 print(f"Error updating buttons: {e}")
 
         def on_text_changed():
-            cmds.evalDeferred(lambda: update_button_states())
+            # Coalesce keystrokes, a deferred update only runs if no newer one has been queued since
+            self._update_generation += 1
+            generation = self._update_generation
+            cmds.evalDeferred(lambda: update_button_states() if generation == self._update_generation else None)
 
         def save_changes():
             new_command = get_command()
@@ -635,54 +854,148 @@ class BatchScriptExecutionUI:
             cmds.confirmDialog(title=context + " Failed", message=reason, button=["Dismiss"], defaultButton="Dismiss",
                                cancelButton="Dismiss", dismissString="Dismiss")
 
-        def do_gather_maya_files(directory, recursion_depth):
+        def do_gather_maya_files(directory, recursion_depth, skip_re=None, file_types=None):
             """
-            Recursively searches for Maya files (.mb and .ma) in the given directory up to the specified depth.
+            Searches for Maya files (.mb and .ma) in the given directory up to the specified depth.
 
             Parameters:
             - directory (str): The path to the directory where the search should begin.
             - depth (int): The maximum depth of recursion. A depth of 0 means only the current directory.
+            - skip_re (re.Pattern): Files whose name (excluding extension) matches this pattern are skipped.
+            - file_types (frozenset): Lowercase extensions (without the dot) to keep, all Maya files are kept if empty.
 
-            Returns:
-            - list: A list of paths to Maya files found within the specified depth.
+            Yields:
+            - tuple: (path, os.stat_result) for each Maya file found within the specified depth.
             """
-            maya_files = []
             if recursion_depth < 0:
-                return maya_files  # Return an empty list if depth is negative
-
-            # Process all entries in the current directory
-            for entry in os.scandir(directory):
-                if entry.is_file() and (entry.name.endswith('.mb') or entry.name.endswith('.ma')):
-                    normalized_path = os.path.normpath(entry.path).replace('\\',
-                                                                           '/')  # We don't want a back-slash on windows
-                    maya_files.append(normalized_path)  # Add file to list if it's a Maya file
-
-            if recursion_depth > 0:
-                # Recurse into subdirectories if depth is greater than 0
-                for entry in os.scandir(directory):
-                    if entry.is_dir():  # Check if the entry is a directory
-                        # Recursively search in the subdirectory with decremented depth
-                        normalized_path = os.path.normpath(entry.path).replace('\\',
-                                                                               '/')  # We don't want a back-slash on windows
-                        maya_files.extend(do_gather_maya_files(normalized_path, recursion_depth - 1))
-
-            return maya_files
-
-        def gather_maya_files(context):
+                return  # Nothing to yield if depth is negative
+
+            # Fold the file type filter into the Maya extension check, so one endswith rejects most entries
+            # before any name parsing. Nothing can match if none of the wanted types are Maya files
+            extensions = tuple(extension for extension in MAYA_EXTS if not file_types or extension[1:] in file_types)
+            if not extensions:
+                return
+
+            # Only platforms with a back-slash separator need their paths converted
+            translate_slashes = os.sep != '/'
+
+            # Iterative breadth-first walk, so shallower files come first and deep trees can't hit the recursion limit.
+            # DirEntry.is_file/is_dir reuse the type from the directory listing, only symlinks (which are followed) need a stat
+            # Normalizing the root once is enough, scandir joins plain names onto it so every path below stays
+            # normalized, and '.'/'..' segments typed into the directory field never reach the dialog or cmds.file
+            pending_directories = deque([(os.path.normpath(directory), recursion_depth)])
+            while pending_directories:
+                current_directory, depth = pending_directories.popleft()
+                with os.scandir(current_directory) as it:
+                    for entry in it:
+                        if entry.is_file():
+                            name = entry.name
+                            if not name.lower().endswith(extensions):
+                                continue
+
+                            # Name filters are applied here rather than in a second pass over the gathered list
+                            if skip_re and skip_re.search(os.path.splitext(name)[0]):
+                                continue
+
+                            # Keep the stat, free on Windows where it comes with the listing, so PendingFile needn't stat again
+                            path = entry.path.translate(_SLASH_TABLE) if translate_slashes else entry.path
+                            yield path, entry.stat()
+                        elif depth > 0 and entry.is_dir():
+                            pending_directories.append((entry.path, depth - 1))
+
+        def get_batch_config():
+            prefix = cmds.textFieldGrp(self.settings_prefix, query=True, text=True)
+            suffix = cmds.textFieldGrp(self.settings_suffix, query=True, text=True)
+            filter_string = cmds.textFieldGrp(self.settings_filter, query=True, text=True)
+            file_type = cmds.textFieldGrp(self.settings_file_type, query=True, text=True)
+            file_type = file_type.replace(" ", "").split(',') if file_type else []  # Trim whitespace
+
+            # Combine the skip filters into one pattern, so each file name is tested with a single regex search
+            skip_patterns = []
+            if prefix:
+                skip_patterns.append(r'\A' + re.escape(prefix))
+            if suffix:
+                skip_patterns.append(re.escape(suffix) + r'\Z')
+            if filter_string:
+                skip_patterns.append(re.escape(filter_string))
+
+            command = cmds.optionVar(query=BatchScriptExecutionStatics.command_option_var)
+            command_type = "python" if cmds.radioButtonGrp(command_type_radio, query=True, select=True) == 1 else "mel"
+            if not isinstance(command, str) or not command.strip():
+                # optionVar returns 0 when no script has ever been saved
+                raise ValueError("No saved script to execute, save the script first")
+
+            return BatchConfig(
+                command=command,
+                command_type=command_type,
+                wants_save=cmds.checkBox(self.save_checkbox, query=True, value=True),
+                recursion_depth=cmds.intFieldGrp(self.recursion_depth, query=True, value1=True),
+                file_types=frozenset(extension.lower().lstrip('.') for extension in file_type if extension),
+                skip_re=re.compile('|'.join(skip_patterns)) if skip_patterns else None,
+                code=compile(command, '<batch_script>', 'exec') if command_type == "python" else None,
+            )
+
+        def gather_maya_files(context, config):
             directory = BatchScriptExecutionHelper.get_path()
             if directory is None or directory == "" or len(directory) == 0:
                 error_dialog("Export directory not specified", context)
-                return None, False
+                return None
 
             dir_valid, dir_reason = BatchScriptExecutionAccessEntry.check_directory_status(directory)
             if not dir_valid:
                 error_dialog(dir_reason, context)
-                return None, False
+                return None
+
+            return do_gather_maya_files(directory, config.recursion_depth, config.skip_re, config.file_types)
+
+        def process_file(config, pending_file, fresh_status, namespace):
+            """Opens a single file, executes the script on it and optionally saves it"""
+            # --STATUS--
+            # does_not_exist = 1
+            # writable = 2
+            # read_only = 3
+            # skip = 4
+            file = pending_file.path
+            log.debug("Pending file %s: %s", file, pending_file.status)
+
+            # File must be writable, cannot be a new file either
+            if pending_file.status != FileStatus.writable:
+                if pending_file.status == FileStatus.skip:
+                    pending_file.result = FileResult.file_skipped
+                elif pending_file.status == FileStatus.does_not_exist:
+                    pending_file.result = FileResult.file_not_found
+                elif pending_file.status == FileStatus.read_only:
+                    pending_file.result = FileResult.file_read_only
+                pending_file.warning = f"File could not be processed due to file state: {pending_file.status}"
+                print(f"File could not be processed due to file state: {pending_file.status}")
+                return
+
+            # Ensure the file hasn't become missing or read-only (i.e. something changed during validation dialog)
+            if fresh_status != FileStatus.writable:
+                # File has been tampered with and wasn't reflected in the confirmation dialog
+                tampered_missing = fresh_status == FileStatus.does_not_exist
+                pending_file.result = FileResult.file_missing if tampered_missing else FileResult.file_tampered
+                print(f"File has been tampered with and wasn't reflected in the confirmation dialog")
+                return
+
+            # Now we can open the file
+            print(f"[ BatchScriptExecution ] Opening >>> {file}")
+            cmds.file(file, open=True, force=True)
+
+            # Then execute the script
+            if config.command_type == "python":
+                # The file being processed, as scripts could previously read them from locals()
+                namespace['file'] = file
+                namespace['pending_file'] = pending_file
+                exec(config.code, namespace)
+            else:
+                mel.eval(config.command)
+
+            # Save the file if the user wants
+            if config.wants_save:
+                cmds.file(save=True, force=True)
 
-            recursion_depth = cmds.intFieldGrp(self.recursion_depth, query=True, value1=True)
-            maya_files = do_gather_maya_files(directory, recursion_depth)
-            # print(f"gather {len(maya_files)} files, ", recursion_depth, " : ", maya_files)
-            return maya_files, True
+            pending_file.result = FileResult.success
 
         def execute_script():
             if has_pending_changes():
@@ -696,51 +1009,21 @@ class BatchScriptExecutionUI:
                 elif result == "Cancel":
                     return
 
-            command_type = "python" if cmds.radioButtonGrp(command_type_radio, query=True, select=True) == 1 else "mel"
-            command = cmds.optionVar(query=BatchScriptExecutionStatics.command_option_var)
-
             context = "Batch Execute Script"
-            maya_files, valid_directory = gather_maya_files(context) or []
-            if not valid_directory:
-                return
-            if len(maya_files) == 0:
-                cmds.confirmDialog(title=context + " Failed", message="Directory is empty", button=["Dismiss"],
-                                   defaultButton="Dismiss",
-                                   cancelButton="Dismiss", dismissString="Dismiss")
+            try:
+                config = get_batch_config()
+            except (SyntaxError, ValueError, TypeError) as e:  # ValueError also covers null bytes in the source
+                error_dialog(f"Script could not be compiled: {e}", context)
                 return
 
-            # Filter files
-            prefix = cmds.textFieldGrp(self.settings_prefix, query=True, text=True)
-            suffix = cmds.textFieldGrp(self.settings_suffix, query=True, text=True)
-            filter_string = cmds.textFieldGrp(self.settings_filter, query=True, text=True)
-            file_type = cmds.textFieldGrp(self.settings_file_type, query=True, text=True)
-            if file_type:
-                file_type = file_type.replace(" ", "")  # Trim whitespace
-                file_type = file_type.split(',')
-
-            filtered_files = []
-            removed_files = []
-            for file in maya_files:
-                file_name = os.path.basename(file)
-                file_extension = file_name.split(".")[-1]
-                file_name = file_name.split(".")[0]
-                # print(f"file_name: {file_name}, has prefix: {prefix and file_name.startswith(prefix)}, has suffix: {suffix and file_name.endswith(suffix)}, has filter: {filter_string and filter_string in file_name}, has type: {file_name.endswith(tuple(file_type))}")
-                if prefix and file_name.startswith(prefix):
-                    removed_files.append(file)
-                    continue
-                if suffix and file_name.endswith(suffix):
-                    removed_files.append(file)
-                    continue
-                if filter_string and filter_string in file_name:
-                    continue
-                if file_type and file_extension not in file_type:
-                    continue
-                filtered_files.append(file)
-
-            maya_files = filtered_files
-            # print(f"filtered files: {removed_files}")
-
-            if len(maya_files) == 0:
+            BatchScriptExecutionAccessEntry.clear_stat_cache()  # Start every batch from fresh file statuses
+            maya_files_iter = gather_maya_files(context, config)
+            if maya_files_iter is None:
+                return  # The reason has already been shown to the user
+
+            # Consume the gather straight into the pending files, without an intermediate list
+            pending_files = {file_path: PendingFile(file_path, stat_result=stat_result) for file_path, stat_result in maya_files_iter}
+            if len(pending_files) == 0:
                 cmds.confirmDialog(title=context + " Failed", message="No files to process after filtering", button=["Dismiss"],
                                    defaultButton="Dismiss",
                                    cancelButton="Dismiss", dismissString="Dismiss")
@@ -749,7 +1032,7 @@ class BatchScriptExecutionUI:
             # Confirm that the user wants to proceed if there are more than a few files
             result = cmds.confirmDialog(
                 title='Confirm Batch Script Execution',
-                message=f"Continue script execution for {len(maya_files)} files?\n\nThis process can potentially take a long time, because every file must be opened.",
+                message=f"Continue script execution for {len(pending_files)} files?\n\nThis process can potentially take a long time, because every file must be opened.",
                 button=['Continue', 'Abort'],
                 defaultButton='Continue',
                 cancelButton='Abort',
@@ -758,12 +1041,6 @@ class BatchScriptExecutionUI:
             if result == 'Abort':
                 return
 
-            wants_save = cmds.checkBox(self.save_checkbox, query=True, value=True)
-
-            pending_files = {}
-            for file_path in maya_files:
-                    pending_files[file_path] = PendingFile(file_path)
-
             # Build dict for exporting
             handler = BatchScriptExecutionAccessHandler("Confirm File List for Script Batch Execution", pending_files)
             if not handler.result:
@@ -772,48 +1049,18 @@ class BatchScriptExecutionUI:
 
             print(f"Executing script on {len(pending_files)} files")
 
+            # Re-check every writable file up front, in parallel since stat releases the GIL. Opening files and
+            # running the script has to stay serial, so the loop below only looks up the result
+            BatchScriptExecutionAccessEntry.clear_stat_cache()
+            check_paths = [file for file, pending_file in handler.files.items() if pending_file.status == FileStatus.writable]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+                fresh_status = dict(zip(check_paths, executor.map(BatchScriptExecutionAccessEntry.check_file_status, check_paths)))
+
+            # One explicit namespace for the whole batch, rather than materializing this frame's locals() per file.
+            # It starts from the module globals so scripts keep access to cmds, mel, os, sys etc.
+            namespace = dict(globals(), __name__='__batch__')
             for file, pending_file in handler.files.items():
-                # --STATUS--
-                # does_not_exist = 1
-                # writable = 2
-                # read_only = 3
-                # skip = 4
-                print(f"pending file: {pending_file.status}")
-
-                # File must be writable, cannot be a new file either
-                if pending_file.status != FileStatus.writable:
-                    if pending_file.status == FileStatus.skip:
-                        pending_file.result = FileResult.file_skipped
-                    elif pending_file.status == FileStatus.does_not_exist:
-                        pending_file.result = FileResult.file_not_found
-                    elif pending_file.status == FileStatus.read_only:
-                        pending_file.result = FileResult.file_read_only
-                    pending_file.warning = f"File could not be processed due to file state: {pending_file.status}"
-                    print(f"File could not be processed due to file state: {pending_file.status}")
-                    continue
-
-                # Ensure the file hasn't become missing or read-only (i.e. something changed during validation dialog)
-                status = BatchScriptExecutionAccessEntry.check_file_status(file)
-                if status != FileStatus.writable:
-                    # File has been tampered with and wasn't reflected in the confirmation dialog
-                    tampered_missing = not os.path.exists(file)
-                    pending_file.result = FileResult.file_missing if tampered_missing else FileResult.file_tampered
-                    print(f"File has been tampered with and wasn't reflected in the confirmation dialog")
-                    continue
-
-                # Now we can open the file
-                print(f"[ BatchScriptExecution ] Opening >>> {file}")
-                cmds.file(file, open=True, force=True)
-
-                # Then execute the script
-                if command_type == "python":
-                    exec(command, globals(), locals())
-                else:
-                    mel.eval(command)
-
-                # Save the file if the user wants
-                if wants_save:
-                    cmds.file(save=True, force=True)
+                process_file(config, pending_file, fresh_status.get(file), namespace)
 
             # Close the final scene without saving
             cmds.file(new=True, force=True)